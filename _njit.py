@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+
+Optional numba support
+If numba is not installed, njit is a no-op decorator and the kernels run as plain Python
+
+"""
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """No-op replacement for numba.njit
+
+        Supports both the bare form (@njit) and the form with a signature and/or options
+        (@njit('int8[:](float64[:, ::1])', cache=True))
+        """
+
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+
+        def decorator(func):
+            return func
+
+        return decorator
@@ -1,9 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+
+Mean reversion strategy
+
+The model is fitted by a numba kernel compiled with explicit signatures (for float32 and float64 prices),
+so the first import compiles it (once) and later imports load it from the numba cache, without any
+compilation in the backtest
+
+"""
+
 import pandas as pd
 import numpy as np
-from sklearn.linear_model import LinearRegression
-from dateutil.relativedelta import relativedelta
 
-def mean_reversion_open(t, quotes, open_actions, close_actions):
+from _njit import njit
+from strategies import cross_sectional
+
+
+@njit(['int8[:](float32[:, ::1])', 'int8[:](float64[:, ::1])'], cache=True, fastmath=True, boundscheck=False)
+def _mean_reversion_kernel(z):
+    """Fit the mean reversion model dz = a + b * z for each column of z by OLS, and classify the
+    predictions of the next dz in terciles
+
+    Parameters
+    ----------
+    z : numpy.ndarray
+        C-contiguous 2D float32 or float64 array of log prices, with a row for each session and a column for
+        each symbol. The sums are always accumulated in float64
+
+    Returns
+    ----------
+    numpy.ndarray
+        int8 array with -1 (sell), 1 (buy) or 0 (neutral) for each symbol
+    """
+
+    nt, ns = z.shape
+    n = nt - 1
+
+    # First pass: means of z and dz
+    mx = np.zeros(ns)
+    my = np.zeros(ns)
+    for i in range(n):
+        for s in range(ns):
+            mx[s] += z[i, s]
+            my[s] += z[i + 1, s] - z[i, s]
+    for s in range(ns):
+        mx[s] /= n
+        my[s] /= n
+
+    # Second pass: centered sums (more stable than the raw sums of squares)
+    sxx = np.zeros(ns)
+    sxy = np.zeros(ns)
+    for i in range(n):
+        for s in range(ns):
+            dx = z[i, s] - mx[s]
+            sxx[s] += dx * dx
+            sxy[s] += dx * (z[i + 1, s] - z[i, s] - my[s])
+
+    # A constant price has no variance: fall back to slope 0 (the intercept is then the mean return)
+    zpred = np.empty(ns)
+    for s in range(ns):
+        slope = sxy[s] / sxx[s] if sxx[s] > 0 else 0.0
+        zpred[s] = my[s] - slope * mx[s] + slope * z[nt - 1, s]
+
+    # Terciles, interpolated as in numpy.percentile, but from a partial sort (O(n)) instead of a full sort
+    pos_lower = (ns - 1) / 3
+    pos_upper = 2 * (ns - 1) / 3
+    k_lower = int(pos_lower)
+    k_upper = int(pos_upper)
+    next_lower = min(k_lower + 1, ns - 1)
+    next_upper = min(k_upper + 1, ns - 1)
+    part = np.partition(zpred, np.array([k_lower, next_lower, k_upper, next_upper]))
+
+    lower = part[k_lower] + (part[next_lower] - part[k_lower]) * (pos_lower - k_lower)
+    upper = part[k_upper] + (part[next_upper] - part[k_upper]) * (pos_upper - k_upper)
+    lower = min(lower, 0.0)
+    upper = max(upper, 0.0)
+
+    buy_sell = np.empty(ns, dtype=np.int8)
+    for s in range(ns):
+        if zpred[s] <= lower:
+            buy_sell[s] = -1
+        elif zpred[s] >= upper:
+            buy_sell[s] = 1
+        else:
+            buy_sell[s] = 0
+
+    return buy_sell
+
+
+@cross_sectional
+def mean_reversion_open(quotes, rows, open_actions):
     """Mean reversion strategy at session open:
     
         Adjust a mean reversion model for all quotes using the last month of open data (both close and open)
@@ -18,65 +104,64 @@ def mean_reversion_open(t, quotes, open_actions, close_actions):
 
     Parameters
     ----------
-    t : date
-        Date of the session
-
     quotes : Quotes
         Market data
 
-    open_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session open
+    rows : numpy.ndarray
+        Positions of the sessions in the market data
 
-    close_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session close
+    open_actions : numpy.ndarray
+        Actions taken in the session opens (None for open signals)
 
     Returns
     ----------
-    pandas.DataFrame
-        DataFrame with the actions on the open of t
+    numpy.ndarray
+        int8 array with the actions of every session (one row per session, one column per symbol)
 
     Raises
     ----------
     ValueError
-        If there is not enough data en self.quotes.close
+        If there is not enough data en self.quotes.close, or some open price of the previous month is missing
     """
 
-    month_ago = t - relativedelta(months=1)
-
-    try:
-        previous_month = quotes.close.index[(quotes.close.index >= month_ago) & (quotes.close.index < t) ]
-    except:
+    # The log of the open prices is cached by quotes, so it is only computed once per backtest.
+    # float32 prices (as stored by Quotes) are kept in float32, anything else is converted to float64
+    index = quotes.close.index
+    log_open = quotes.log_open
+    if log_open.dtype != np.float32:
+        log_open = log_open.astype(np.float64)
+
+    # The index is sorted, so the previous month of each session is a contiguous block of rows, which
+    # starts at the first row of the index not older than a month before the session. All the starts are
+    # found with a single searchsorted
+    month_ago = index[rows] - pd.DateOffset(months=1)
+    first_rows = index.searchsorted(month_ago, side='left')
+
+    # At least two sessions are needed to fit the model
+    short = np.flatnonzero(rows - first_rows < 2)
+    if short.size:
+        t = index[rows[short[0]]]
         date_error = 'Cannot find data for the previous month to {} in self.quotes.close'.format(t)
-        raise (ValueError(date_error))
-
-    # Calibrate mean reversion model
-    # (we are considering t in sessions, so dt for the weekend is still 1)
-    data = quotes.open.loc[previous_month, :]
-    z = np.log(data)
-    dz = z - z.shift(1)
-    zpred = []
-    nd = z.shape[0] - 1
-
-    for s in quotes.symbols:
-        lm = LinearRegression(fit_intercept=True)
-        y = dz.loc[dz.index[1:], s].as_matrix().reshape((nd, 1))
-        x = z.loc[z.index[:-1], s].as_matrix().reshape((nd, 1))
-        lm.fit(x, y)
-        zpred.append(lm.predict(z.loc[z.index[-1], s]))
-
-    # Calculate the percentiles
-    barriers = np.percentile(zpred, [100 / 3, 2 * 100 / 3])
-    buy_sell = []
-
-    for s in zpred:
-        if s <= min(barriers[0], 0):
-            buy_sell.append(-1)
-        elif s >= max(barriers[1], 0):
-            buy_sell.append(1)
-        else:
-            buy_sell.append(0)
-
-    return buy_sell
+        raise ValueError(date_error)
+
+    # The kernel is compiled with fastmath, so it must not see missing (NaN) or non positive prices: a single
+    # one would change the terciles of all the symbols. The number of rows with some invalid price up to each
+    # row gives, with a subtraction, whether there is any of them in each window
+    invalid = np.concatenate(([0], np.cumsum(~np.isfinite(log_open).all(axis=1))))
+    missing = np.flatnonzero(invalid[rows] - invalid[first_rows] > 0)
+    if missing.size:
+        t = index[rows[missing[0]]]
+        date_error = 'Missing or invalid open prices in the previous month to {} in self.quotes.open'.format(t)
+        raise ValueError(date_error)
+
+    actions = np.zeros((len(rows), log_open.shape[1]), dtype=np.int8)
+
+    for i in range(len(rows)):
+        # Calibrate mean reversion model and classify the predictions
+        # (we are considering t in sessions, so dt for the weekend is still 1)
+        actions[i] = _mean_reversion_kernel(np.ascontiguousarray(log_open[first_rows[i]:rows[i]]))
+
+    return actions
 
 
 # Main function
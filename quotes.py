@@ -6,11 +6,20 @@ Created by Juan Ignacio Gil Gomez, 2017-04-14
 
 """
 
+import os
 import pandas as pd
 import numpy as np
 import pandas_datareader.data as web
+from pandas_datareader._utils import RemoteDataError
+from requests.exceptions import RequestException
+from concurrent.futures import ThreadPoolExecutor
 from warnings import warn
 
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
 default_trading_universe = ['AAPL', 'AXP', 'BA', 'CAT', 'CVX', 'CSCO', 'DIS', 'DD', 'XOM', 'GE', 'GS', 'HD', 'IBM',
                     'INTC', 'JNJ', 'JPM', 'KO', 'MCD', 'MMM', 'MRK', 'MSFT', 'NKE', 'PFE', 'PG', 'TRV', 'UTX',
                     'UNH', 'VZ', 'V', 'WMT']
@@ -20,6 +29,72 @@ default_trading_universe = ['AAPL', 'AXP', 'BA', 'CAT', 'CVX', 'CSCO', 'DIS', 'D
 Default trading universe
 """
 
+quote_fields = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+"""quote_fields : list of str
+
+Fields stored for each quote, in the order of the first axis of the Quotes data array
+"""
+
+_price_fields = [field for field in quote_fields if field != 'Volume']
+
+"""_price_fields : list of str
+
+Fields stored in the float32 price array of Quotes, in the order of its first axis (Volume is stored apart,
+in float64)
+"""
+
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'strategysim')
+
+"""cache_dir : str
+
+Directory where download_quote caches the history of each ticker, as a parquet file
+"""
+
+def _cache_path(ticker):
+    """Path of the parquet file with the cached history of a ticker"""
+
+    return os.path.join(cache_dir, '{}.parquet'.format(ticker))
+
+
+def _read_cache(ticker):
+    """Cached history of a ticker, or None if it is not cached or the cache can't be read (no parquet support
+    in pandas or no parquet engine, or a corrupt or unreadable file)"""
+
+    path = _cache_path(ticker)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        return pd.read_parquet(path)
+    except (AttributeError, ImportError, OSError, ValueError):
+        return None
+
+
+def _write_cache(ticker, quote):
+    """Saves the history of a ticker in the cache (if pandas supports parquet, a parquet engine is installed
+    and the cache directory can be written; otherwise, the data is just not cached)"""
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        quote.to_parquet(_cache_path(ticker), compression='zstd')
+    except (AttributeError, ImportError, OSError):
+        pass
+
+
+def _warn_incomplete(ticker, missing):
+    """Warns about the dates of a ticker that could not be downloaded, and were taken from the cache only"""
+
+    for start, end in missing:
+        w_string = 'No data for {} from {:%Y-%m-%d} to {:%Y-%m-%d}, using the cached data only'.format(
+            ticker, start, end)
+        warn(w_string)
+
+
+# Complete results of download_quote, by (ticker, start_date, end_date)
+_downloaded = {}
+
+
 def download_quote(ticker, start_date=pd.datetime(2000, 1, 1), end_date=pd.to_datetime('today')):
     """
     Downloads historical data of a quote from Google Finance
@@ -39,14 +114,134 @@ def download_quote(ticker, start_date=pd.datetime(2000, 1, 1), end_date=pd.to_da
     -------
     pandas.DataFrame
         DataFrame with the requested historical data
-        
+
+    Notes
+    ----------
+    The history of each ticker is cached in cache_dir/<ticker>.parquet, and only the dates missing from
+    the cache are requested to Google Finance (the last cached session is always requested again, in
+    case it was incomplete). If those requests fail, the function warns and returns the cached data
+    that it has for the period. If no parquet engine is installed, or the cache can't be read or written,
+    the data is downloaded every time.
+
+    Complete results are also memoized in memory for each (ticker, start_date, end_date), so the
+    returned DataFrame should not be modified. Incomplete ones are not, so they are requested again
+    the next time.
     """
 
-    quote = web.DataReader(ticker, 'google', start_date, end_date)
+    quote, missing = _download_quote(ticker, start_date, end_date)
+    _warn_incomplete(ticker, missing)
 
     return quote
 
 
+def _download_quote(ticker, start_date, end_date):
+    """download_quote, returning the date ranges that could not be downloaded instead of warning about them
+    (so that it can run in worker threads, and the warnings are raised by the caller)
+
+    Returns
+    -------
+    quote : pandas.DataFrame
+        DataFrame with the requested historical data
+    missing : list of tuple
+        (start, end) of the date ranges that could not be downloaded, and were taken from the cache only
+    """
+
+    start_date = pd.to_datetime(start_date)
+    end_date = pd.to_datetime(end_date)
+
+    key = (ticker, start_date, end_date)
+    if key in _downloaded:
+        return _downloaded[key], []
+
+    cached = _read_cache(ticker)
+    failed = []
+
+    if cached is None or cached.empty:
+        quote = web.DataReader(ticker, 'google', start_date, end_date)
+        _write_cache(ticker, quote)
+    else:
+        first_cached = cached.index[0]
+        last_cached = cached.index[-1]
+
+        # Missing dates before and after the cached data
+        missing = []
+        if start_date < first_cached:
+            missing.append((start_date, first_cached - pd.Timedelta(days=1)))
+        if end_date >= last_cached:
+            missing.append((last_cached, end_date))
+
+        pieces = [cached]
+        for start, end in missing:
+            try:
+                pieces.append(web.DataReader(ticker, 'google', start, end))
+            except (RemoteDataError, RequestException, ValueError):
+                failed.append((start, end))
+
+        if len(pieces) == 1:
+            quote = cached
+        else:
+            quote = pd.concat(pieces)
+            quote = quote[~quote.index.duplicated(keep='last')].sort_index()
+            _write_cache(ticker, quote)
+
+    quote = quote.loc[start_date:end_date]
+    if not failed:
+        _downloaded[key] = quote
+
+    return quote, failed
+
+
+def download_quotes(tickers, start_date=pd.datetime(2000, 1, 1), end_date=pd.to_datetime('today')):
+    """
+    Downloads historical data of several quotes from Google Finance in a single request
+
+    Parameters
+    ----------
+    tickers : list of str
+        Ticker symbols
+    start_date : date
+        First historical date to retrieve
+        Defaults to 2000-1-1
+    end_date : date
+        Last historical date to retrieve.
+        Defaults to today
+
+    Returns
+    -------
+    dict
+        DataFrame with the historical data of each ticker, by ticker symbol. Tickers without data are
+        not included
+
+    Notes
+    ----------
+    The data of each ticker is saved in the cache used by download_quote
+    """
+
+    # The result has a DataFrame (dates x tickers) for each field
+    batch = web.DataReader(list(tickers), 'google', start_date, end_date)
+
+    quotes = {}
+    for ticker in tickers:
+        if ticker not in batch['Close'].columns:
+            continue
+
+        quote = pd.DataFrame({field: batch[field][ticker] for field in quote_fields}).dropna(how='all')
+        if not quote.empty:
+            _write_cache(ticker, quote)
+            quotes[ticker] = quote
+
+    return quotes
+
+
+def _safe_download(ticker, start_date, end_date):
+    """_download_quote, returning (None, []) instead of raising if the download fails"""
+
+    try:
+        return _download_quote(ticker, start_date, end_date)
+    except (RemoteDataError, RequestException, ValueError):
+        return None, []
+
+
 class Quotes():
     """Class to download and store quotes
 
@@ -60,6 +255,27 @@ class Quotes():
     low :  pandas.DataFrame
     close : pandas.DataFrame
     volume : pandas.DataFrame
+    log_open : numpy.ndarray
+        Log of the open prices, cached
+    log_close : numpy.ndarray
+        Log of the close prices, cached
+
+    Notes
+    ----------
+    The prices are stored in a single contiguous float32 array of shape (fields, dates, equities), with
+    the fields in the order of _price_fields. The volume is stored apart, in a float64 array of shape
+    (dates, equities), so that volumes over 2**24 are kept exactly. open, high, low, close and volume are
+    DataFrames built on every access over views of those arrays, so they don't copy the data.
+
+    All the fields share the same dates and equities. Assigning a DataFrame to one of them (for example,
+    quotes.close = df) replaces the stored data, with the dates and equities of the new DataFrame (the
+    other fields are reindexed to them)
+
+    log_open and log_close are computed once and cached, so the stored data can only be changed through
+    the object. The frames are read-only views, so editing their values in place
+    (quotes.close.loc[day, symbol] = x) raises ValueError, and each access returns a new frame, so
+    replacing a column of one (quotes.close['AAPL'] = s) only changes that frame, not the stored data.
+    To change the data, assign a modified copy (quotes.close = df), which rebuilds the caches
     """
 
     def __init__(self, trading_universe=default_trading_universe, download=True, **kwargs):
@@ -91,13 +307,9 @@ class Quotes():
         if isinstance(trading_universe, str):
             trading_universe = [trading_universe]
 
-        self.symbols = trading_universe
+        self._set_data(np.empty((len(quote_fields), 0, 0)), pd.DatetimeIndex([]), [])
 
-        self.open = pd.DataFrame()
-        self.close = pd.DataFrame()
-        self.high = pd.DataFrame()
-        self.low = pd.DataFrame()
-        self.volume = pd.DataFrame()
+        self.symbols = trading_universe
 
         # If download is True, download data from Google Finance
         if download:
@@ -109,6 +321,171 @@ class Quotes():
 
         return 'Quote: {}'.format(self.symbols)
 
+    @property
+    def open(self):
+        return self._frame('Open')
+
+    @open.setter
+    def open(self, frame):
+        self._set_field('Open', frame)
+
+    @property
+    def high(self):
+        return self._frame('High')
+
+    @high.setter
+    def high(self, frame):
+        self._set_field('High', frame)
+
+    @property
+    def low(self):
+        return self._frame('Low')
+
+    @low.setter
+    def low(self, frame):
+        self._set_field('Low', frame)
+
+    @property
+    def close(self):
+        return self._frame('Close')
+
+    @close.setter
+    def close(self, frame):
+        self._set_field('Close', frame)
+
+    @property
+    def volume(self):
+        return self._frame('Volume')
+
+    @volume.setter
+    def volume(self, frame):
+        self._set_field('Volume', frame)
+
+    @property
+    def log_open(self):
+        """numpy.ndarray : Log of the open prices, computed on the first access"""
+        return self._log('Open')
+
+    @property
+    def log_close(self):
+        """numpy.ndarray : Log of the close prices, computed on the first access"""
+        return self._log('Close')
+
+    @classmethod
+    def from_array(cls, values, index, columns):
+        """Builds a Quotes instance from market data already in memory, without downloading anything
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            Array of shape (len(quote_fields), len(index), len(columns)), with the fields in the order of
+            quote_fields (as returned by to_array)
+        index : pandas.DatetimeIndex
+            Dates of the data
+        columns : list of str
+            Ticker symbols of the data
+
+        Returns
+        ----------
+        Quotes
+            Quotes with the given data
+        """
+
+        quotes = cls(list(columns), download=False)
+        quotes._set_data(values, index, columns)
+
+        return quotes
+
+    def to_array(self):
+        """Copy of all the market data, in a single array
+
+        Returns
+        ----------
+        numpy.ndarray
+            Array of shape (len(quote_fields), dates, symbols), with the fields in the order of quote_fields
+        """
+
+        values = np.empty((len(quote_fields), len(self._index), len(self._columns)))
+        for i, field in enumerate(quote_fields):
+            values[i] = self._field(field)
+
+        return values
+
+    def _set_data(self, values, index, columns):
+        """Replaces the stored data
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            Array of shape (len(quote_fields), len(index), len(columns)), with the fields in the order of
+            quote_fields. The prices are stored in float32 and the volume in float64
+        index : pandas.DatetimeIndex
+            Dates of the data
+        columns : list of str
+            Ticker symbols of the data
+        """
+
+        prices = [quote_fields.index(field) for field in _price_fields]
+        self._values = np.ascontiguousarray(values[prices], dtype=np.float32)
+        self._volume = np.ascontiguousarray(values[quote_fields.index('Volume')], dtype=np.float64)
+        self._index = index
+        self._columns = list(columns)
+        self._logs = {}
+
+        # The symbols are always the ones in the data
+        self.symbols = list(columns)
+
+    def _set_field(self, field, frame):
+        """Replaces the data of a field, reindexing the other fields to its dates and equities
+
+        Parameters
+        ----------
+        field : str
+            One of quote_fields
+        frame : pandas.DataFrame
+            New data of the field, with a column for each equity
+        """
+
+        frame = pd.DataFrame(frame)
+        index = frame.index
+        columns = frame.columns
+
+        values = np.empty((len(quote_fields), len(index), len(columns)))
+        for i, f in enumerate(quote_fields):
+            source = frame if f == field else self._frame(f)
+            values[i] = source.reindex(index=index, columns=columns).values
+
+        self._set_data(values, index, columns)
+
+    def _field(self, field):
+        """Stored array of one of the fields"""
+
+        if field == 'Volume':
+            return self._volume
+
+        return self._values[_price_fields.index(field)]
+
+    def _frame(self, field):
+        """Read-only DataFrame view of one of the fields of the data array
+
+        A new DataFrame is built on every call (it doesn't copy the data), so that changes to a returned
+        DataFrame (like assigning a column) can't be seen by the rest of the object
+        """
+
+        # The views are read-only, so that the data can't be edited behind the cached logs
+        view = self._field(field).view()
+        view.flags.writeable = False
+
+        return pd.DataFrame(view, index=self._index, columns=self._columns, copy=False)
+
+    def _log(self, field):
+        """Log of one of the fields of the data array, computed on the first access"""
+
+        if field not in self._logs:
+            self._logs[field] = np.log(self._field(field))
+
+        return self._logs[field]
+
     def download(self, start_date=pd.datetime(2000, 1, 1), end_date=pd.to_datetime('today')):
         """Downloads historical data from Google Finance for all quotes in the trading universe of the object
 
@@ -125,38 +502,81 @@ class Quotes():
         ----------
         If the download does not work for a quote, the function outputs a warning and continues, 
         without trying to add the data
-        """
 
-        for ticker in self.symbols:
-            try:
-                data = download_quote(ticker, start_date, end_date)
+        Quotes that are not in the cache are requested in a single batch (see download_quotes). If the
+        source rejects the batch request, they are downloaded one by one with download_quote
 
-                self.open[ticker] = data['Open']
-                self.close[ticker] = data['Close']
-                self.high[ticker] = data['High']
-                self.low[ticker] = data['Low']
-                self.volume[ticker] = data['Volume']
+        After the download, symbols only lists the quotes with data
+        """
 
-            except:
+        # Tickers that are not cached yet are requested in a single batch
+        downloaded = {}
+        uncached = [ticker for ticker in self.symbols if not os.path.exists(_cache_path(ticker))]
+        if len(uncached) > 1:
+            try:
+                downloaded = download_quotes(uncached, start_date, end_date)
+            except (RemoteDataError, RequestException, ValueError, KeyError):
+                pass
+
+        # The rest (and all of them, if the source rejects the batch request) are downloaded one by one.
+        # Downloads are network bound, so they run in a thread pool. The results are stored (and the
+        # warnings raised) here, in the main thread
+        pending = [ticker for ticker in self.symbols if ticker not in downloaded]
+        with ThreadPoolExecutor(max_workers=max(1, min(16, len(pending)))) as executor:
+            results = list(executor.map(lambda ticker: (ticker, _safe_download(ticker, start_date, end_date)),
+                                        pending))
+
+        for ticker, (data, missing) in results:
+            _warn_incomplete(ticker, missing)
+            if data is None:
                 w_string = 'No data for {}'.format(ticker)
                 warn(w_string)
+            else:
+                downloaded[ticker] = data
+
+        downloaded = {ticker: downloaded[ticker] for ticker in self.symbols if ticker in downloaded}
+
+        # Build each field in one go (columns in the order of self.symbols), instead of inserting the
+        # columns one by one, and copy it into the data array
+        if downloaded:
+            frames = [pd.concat({ticker: data[field] for ticker, data in downloaded.items()}, axis=1)
+                      for field in quote_fields]
+            index = frames[0].index
+            columns = frames[0].columns
+
+            values = np.empty((len(quote_fields), len(index), len(columns)))
+            for i, frame in enumerate(frames):
+                values[i] = frame.reindex(index=index, columns=columns).values
+
+            self._set_data(values, index, columns)
 
 
     def find_biggest_jump(self):
 
-        intraday_jumps = np.abs(np.log(self.close) - np.log(self.open))
-        max_jumps = intraday_jumps.max(axis=0)
-        max_symbol = np.argmax(max_jumps)
-        day_max = np.argmax(intraday_jumps[max_symbol])
+        log_open = self.log_open
+        log_close = self.log_close
+
+        # A single reduction over the whole array (the elementwise part is fused in a single pass by
+        # numexpr, if it is installed)
+        if ne is not None:
+            intraday_jumps = ne.evaluate('abs(log_close - log_open)')
+        else:
+            intraday_jumps = np.abs(log_close - log_open)
+        day_max, max_symbol = np.unravel_index(np.nanargmax(intraday_jumps), intraday_jumps.shape)
 
-        return day_max, max_symbol
+        return self._index[day_max], self._columns[max_symbol]
 
     def remove_biggest_jump(self):
 
         #to_remove =  (pd.datetime(2016, 11, 9), 'DD')
         to_remove = self.find_biggest_jump()
 
-        self.close.loc[to_remove[0], to_remove[1]] = self.open.loc[to_remove[0], to_remove[1]]
+        # Write directly in the data array, so that all the views see the change
+        day = self._index.get_loc(to_remove[0])
+        symbol = self._columns.index(to_remove[1])
+        close = _price_fields.index('Close')
+        self._values[close, day, symbol] = self._values[_price_fields.index('Open'), day, symbol]
+        self._logs.pop('Close', None)
 
 
 
@@ -6,11 +6,21 @@ Created by Juan Ignacio Gil Gomez, 2017-04-15
 
 """
 
+import os
+import copy
 import pandas as pd
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor
+
+from _njit import njit
 from quotes import Quotes
 
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
 
 class Strategy(object):
     """Class for strategy backtesting
@@ -20,9 +30,9 @@ class Strategy(object):
     quotes : Quotes
         instance of quotes, containing market data
     open_signal : function
-        Function that returns a 'Buy', 'Close' or 'Neutral' signal at market open
+        Function that returns the actions at market open of every session
     close_signal : function
-        Function that returns a 'Buy', 'Close' or 'Neutral' signal at market close
+        Function that returns the actions at market close of every session
     start_date : date
         First historical date to retrieve
         Defaults to 1 year ago
@@ -40,10 +50,10 @@ class Strategy(object):
             quotes : Quote
                 Quote instance, with market data.
             open_signal : function
-                Function that returns a list with position changes at market open
+                Function that returns an array with position changes at market open
                 By default, buy_at_start
             close_signal : function
-                Function that returns a list with position changes at market close
+                Function that returns an array with position changes at market close
                 By default, hold
             start_date : date
                 First historical date to retrieve
@@ -54,10 +64,13 @@ class Strategy(object):
             spread : constant value to simulate bid/ask spread and fees
                 Defaults to 0
         """
-        self.start_date = kwargs.get('start_date', pd.to_datetime('today') - pd.Timedelta(days=365))
-        self.end_date = kwargs.get('end_date', pd.to_datetime('today'))
-        self.quotes = kwargs.get('quotes',
-                                 Quotes(start_date=self.start_date - pd.Timedelta(days=30), end_date=self.end_date))
+        # The defaults are only computed if they are needed (kwargs.get would evaluate them always, and the
+        # default quotes download the whole default trading universe)
+        self.start_date = kwargs['start_date'] if 'start_date' in kwargs else \
+            pd.to_datetime('today') - pd.Timedelta(days=365)
+        self.end_date = kwargs['end_date'] if 'end_date' in kwargs else pd.to_datetime('today')
+        self.quotes = kwargs['quotes'] if 'quotes' in kwargs else \
+            Quotes(start_date=self.start_date - pd.Timedelta(days=30), end_date=self.end_date)
         self.open_signal = kwargs.get('open_signal', buy_at_start)
         self.close_signal = kwargs.get('close_signal', hold)
         self.spread = kwargs.get('spread', 0)
@@ -89,11 +102,16 @@ class Strategy(object):
                 open signal function. Defaults to self.open_signal
             
             close_signal : function
-                close signal function. Defaults to self.open_signal
+                close signal function. Defaults to self.close_signal
             
             decimals : int
                 Number of decimals to get in the pnl (to make the result more readable. 
                 Defaults to None, where no rounding is made)
+
+            dtype : numpy.dtype
+                Floating point type of the pnl
+                Defaults to numpy.float32 (the precision of the market data). Use numpy.float64 for a
+                double precision pnl
                 
              
         Returns
@@ -112,25 +130,157 @@ class Strategy(object):
         open_signal = kwargs.get('open_signal', self.open_signal)
         close_signal = kwargs.get('close_signal', self.close_signal)
         decimals = kwargs.get('decimals', None)
+        dtype = kwargs.get('dtype', np.float32)
+
+        dates = self.quotes.close.index.intersection(pd.date_range(self.start_date, self.end_date))
+        rows = self.quotes.close.index.get_indexer(dates)
+        columns = self.quotes.close.columns
+
+        # Prices as plain C-contiguous arrays, extracted only once. For Quotes they are already views of its
+        # contiguous data array (so nothing is copied), but the compiled session loop and the vectorized pnl
+        # rely on the layout, so it is guaranteed here
+        open_values = np.ascontiguousarray(self.quotes.open.values)
+        close_values = np.ascontiguousarray(self.quotes.close.values)
+
+        # Actions are stored as int8 when they fit (whole numbers of stocks between -128 and 127), and in a
+        # wider type otherwise (see _store_actions)
+        open_actions = np.zeros((len(dates), len(columns)), dtype=np.int8)
+        close_actions = np.zeros((len(dates), len(columns)), dtype=np.int8)
+
+        # Without sessions in the range the signals are not called, and the result is empty
+        if len(dates):
+            open_session = getattr(open_signal, 'session_signal', False)
+            close_session = getattr(close_signal, 'session_signal', False)
+
+            if open_session and close_session:
+                # Path dependent signals are computed session by session, in a compiled loop
+                loop_open, loop_close = _run_loop(open_signal, close_signal, open_values, close_values, rows)
+                open_actions = _store_actions(open_actions, loop_open)
+                close_actions = _store_actions(close_actions, loop_close)
+            elif open_session or close_session:
+                raise ValueError('Session signals can only be combined with other session signals')
+            else:
+                # The signals return the actions of all the sessions at once, with a row per session
+                open_actions = _store_actions(open_actions, open_signal(self.quotes, rows, None))
+                close_actions = _store_actions(close_actions, close_signal(self.quotes, rows, open_actions))
+
+            # At last day closing we close all open position, regardless of the close signal. If the strategy
+            # accumulates positions, they may not fit in the type of close_actions
+            final_close = close_all(self.quotes, rows, open_actions, close_actions)
+            close_type = np.promote_types(close_actions.dtype, _action_type(final_close))
+            close_actions = close_actions.astype(close_type, copy=False)
+            close_actions[-1, :] = final_close
+
+        # Now we can calculate the pnl without loops (in a single pass, without temporary arrays, by numexpr,
+        # if it is installed). By default it is computed in float32, like the market data, which halves the
+        # memory traffic of float64
+        open_prices = open_values[rows].astype(dtype, copy=False)
+        close_prices = close_values[rows].astype(dtype, copy=False)
+        # Without spread (the default), the cost term is skipped altogether
+        spread = self.spread
+        if ne is not None:
+            pnl = np.empty(open_prices.shape, dtype=dtype)
+            if spread:
+                ne.evaluate('-open_actions * open_prices - close_actions * close_prices - '
+                            '(abs(open_actions) + abs(close_actions)) * spread', out=pnl, casting='same_kind')
+            else:
+                ne.evaluate('-open_actions * open_prices - close_actions * close_prices', out=pnl,
+                            casting='same_kind')
+        else:
+            pnl = -open_actions * open_prices - close_actions * close_prices
+            if spread:
+                pnl -= (np.abs(open_actions) + np.abs(close_actions)) * open_prices.dtype.type(spread)
+            pnl = pnl.astype(dtype, copy=False)
+
+        pnl = pd.DataFrame(pnl, index=dates, columns=columns)
+        open_actions = pd.DataFrame(open_actions, index=dates, columns=columns)
+        close_actions = pd.DataFrame(close_actions, index=dates, columns=columns)
+
+        if decimals:
+            pnl = pnl.round(decimals)
+
+        # If asked, save the pnl in a csv file
+        if csv_file:
+            pnl.to_csv(csv_file)
 
-        dates = [t for t in pd.date_range(self.start_date, self.end_date) if t in self.quotes.close.index]
+        return pnl, open_actions, close_actions
 
-        open_actions = pd.DataFrame(0, index=dates, columns=self.quotes.symbols)
-        close_actions = pd.DataFrame(0, index=dates, columns=self.quotes.symbols)
+    def backtest_parallel(self, **kwargs):
+        """Backtest the strategy splitting the symbols between several processes
 
-        for t in dates:
-            open_actions.loc[t, :] = open_signal(t, self.quotes, open_actions, close_actions)
+        The market data is shared with the workers through shared memory (instead of being pickled for each
+        one), every worker backtests the strategy for a chunk of the symbols, and the results are joined.
 
-            # At last day closing we close all open position, regardless of the close signal
-            if t == dates[-1]:
-                close_actions.loc[t, :] = close_all(t, self.quotes, open_actions, close_actions)
-            else:
-                close_actions.loc[t, :] = close_signal(t, self.quotes, open_actions, close_actions)
+        This is only valid for signals where the actions of a symbol don't depend on the other symbols
+        (like mimic_open or volatility_strategy). Signals marked with the decorator cross_sectional, like
+        mean_reversion_open (which ranks all the symbols against each other), are rejected, as the result
+        would change with the chunks: use backtest for them. Requires Python 3.8 or newer.
+
+        Parameters
+        ----------
+        **kwargs
+            n_workers : int
+                Number of worker processes
+                Defaults to the number of CPUs (and never more than the number of symbols)
+
+            csv_file, open_signal, close_signal, decimals, dtype
+                As in backtest. The signals must be picklable (defined at module level)
+
+        Returns
+        ----------
+        open_actions : pandas.DataFrame
+            DataFrame with actions taken at session open (one column per symbol, where, for example, -1 represents
+            selling 1 stock)
+        close_actions : pandas.DataFrame
+            DataFrame with actions taken at session open (one column per symbol, where, for example, 2 represents
+            buying 2 stocks)
+        pnl : pandas.DataFrame
+            DataFrame with money win or lost each day for each symbol
+
+        Raises
+        ----------
+        ValueError
+            If any of the signals is cross-sectional
+        """
+
+        # shared_memory is only available from Python 3.8 on, so it is not imported with the module
+        from multiprocessing import shared_memory
+
+        n_workers = kwargs.get('n_workers', None) or os.cpu_count() or 1
+        csv_file = kwargs.get('csv_file', '')
+        open_signal = kwargs.get('open_signal', self.open_signal)
+        close_signal = kwargs.get('close_signal', self.close_signal)
+        decimals = kwargs.get('decimals', None)
+        dtype = kwargs.get('dtype', np.float32)
+
+        for signal in (open_signal, close_signal):
+            if getattr(signal, 'cross_sectional', False):
+                raise ValueError('{} is a cross-sectional signal, it can only be backtested with backtest'.format(
+                    getattr(signal, '__name__', signal)))
+
+        values = self.quotes.to_array()
+        index = self.quotes.close.index
+        columns = self.quotes.close.columns
+        chunks = [c for c in np.array_split(np.arange(len(columns)), min(n_workers, len(columns))) if len(c)]
 
-        # Now we can calculate the pnl without loops
-        pnl = -open_actions * self.quotes.open.loc[dates, :] -\
-              close_actions * self.quotes.close.loc[dates, :] - \
-              (abs(open_actions) + abs(close_actions)) * self.spread
+        # The workers get a copy of the strategy without the market data, which they read from shared memory
+        strategy = copy.copy(self)
+        strategy.quotes = None
+
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        try:
+            np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+
+            with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+                futures = [executor.submit(_backtest_chunk, strategy, shm.name, values.shape, values.dtype.str,
+                                           index, columns[chunk], chunk, open_signal, close_signal, dtype)
+                           for chunk in chunks]
+                results = [f.result() for f in futures]
+        finally:
+            shm.close()
+            shm.unlink()
+
+        pnl, open_actions, close_actions = [pd.concat(r, axis=1) for r in zip(*results)]
 
         if decimals:
             pnl = pnl.round(decimals)
@@ -191,97 +341,297 @@ class Strategy(object):
                 output.write(separator)
 
 
+def _store_actions(actions, result):
+    """Stores the actions returned by a signal in a preallocated int8 array, if they fit in it
+
+    Parameters
+    ----------
+    actions : numpy.ndarray
+        Preallocated int8 array, with a row per session and a column per symbol
+    result : numpy.ndarray
+        Actions returned by the signal
+
+    Returns
+    ----------
+    numpy.ndarray
+        actions, filled with result, if all its values are whole numbers between -127 and 127. Otherwise, a
+        copy of result in a type wide enough for them (so that they are never truncated)
+
+    Raises
+    ----------
+    ValueError
+        If result doesn't have a row per session and a column per symbol
+    """
+
+    result = np.asarray(result)
+    if result.shape != actions.shape:
+        raise ValueError('The signal returned an array of shape {}, instead of {} (a row per session and a column '
+                         'per symbol)'.format(result.shape, actions.shape))
+
+    action_type = _action_type(result)
+    if action_type == np.int8:
+        actions[:] = result
+        return actions
+
+    return result.astype(action_type)
+
+
+def _action_type(actions):
+    """Smallest type that holds some actions exactly: a signed integer type if they are all whole numbers,
+    float64 otherwise"""
+
+    if actions.size == 0 or actions.dtype == np.bool_:
+        return np.dtype(np.int8)
+
+    if np.issubdtype(actions.dtype, np.integer) or np.array_equal(actions, np.trunc(actions)):
+        return _int_type(actions.min(), actions.max())
+
+    return np.dtype(np.float64)
+
+
+def _int_type(low, high):
+    """Smallest signed integer type that holds all the values between low and high, and their negatives
+    (float64 if none does)"""
+
+    # The minimum of each type is excluded, as its negative overflows (-(-128) is -128 in int8), and the
+    # actions are negated to close the positions
+    for int_type in (np.int8, np.int16, np.int32, np.int64):
+        if -np.iinfo(int_type).max <= low and high <= np.iinfo(int_type).max:
+            return np.dtype(int_type)
+
+    return np.dtype(np.float64)
+
+
+def _backtest_chunk(strategy, shm_name, shape, dtype, index, columns, chunk, open_signal, close_signal, pnl_dtype):
+    """Backtests a strategy for some of the symbols of the market data in shared memory (run by the workers
+    of Strategy.backtest_parallel)
+
+    Parameters
+    ----------
+    strategy : Strategy
+        Strategy to backtest, without market data
+    shm_name : str
+        Name of the shared memory block with the market data array
+    shape : tuple
+        Shape of the market data array
+    dtype : str
+        Data type of the market data array
+    index : pandas.DatetimeIndex
+        Dates of the market data
+    columns : pandas.Index
+        Ticker symbols of the chunk
+    chunk : numpy.ndarray
+        Positions of the symbols of the chunk in the market data array
+    open_signal : function
+        Open signal function
+    close_signal : function
+        Close signal function
+    pnl_dtype : numpy.dtype
+        Floating point type of the pnl
+
+    Returns
+    ----------
+    tuple of pandas.DataFrame
+        pnl, open actions and close actions for the symbols of the chunk
+    """
+
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        # Indexing the columns of the chunk copies them, so the shared block can be released right away
+        values = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[:, :, chunk]
+    finally:
+        shm.close()
+
+    strategy.quotes = Quotes.from_array(values, index, columns)
+
+    return strategy.backtest(open_signal=open_signal, close_signal=close_signal, dtype=pnl_dtype)
+
+
+# Path dependent signals
+
+def session_signal(kernel):
+    """Decorator for path dependent signals, that can't be computed for all the sessions at once
+
+        The kernel is called once per session, in order, with the signature
+
+            actions = kernel(i, open_values, close_values, rows, open_actions, close_actions)
+
+        where i is the number of the session, open_values and close_values are the arrays with all the
+        open and close prices of the market data, rows are the positions of the sessions in them, and
+        open_actions and close_actions are the arrays with the actions of all the sessions (filled up
+        to the open of session i for open signals, and up to the close of session i for close signals).
+        It returns the actions of session i.
+
+        Decorate the kernel with @njit (from _njit) before this decorator, so that the backtest loop
+        is compiled by numba (if installed). Session signals must be used both at open and at close.
+
+    Parameters
+    ----------
+    kernel : function
+        Function that returns the actions of a single session
+
+    Returns
+    ----------
+    function
+        The same kernel, marked as a session signal
+    """
+
+    kernel.session_signal = True
+
+    return kernel
+
+
+def cross_sectional(signal):
+    """Decorator for signals where the actions of each symbol depend on the other symbols (for example, because
+        they rank all the symbols against each other)
+
+        These signals can't be backtested with Strategy.backtest_parallel, which splits the symbols between
+        several processes.
+
+    Parameters
+    ----------
+    signal : function
+        Signal function
+
+    Returns
+    ----------
+    function
+        The same signal, marked as cross-sectional
+    """
+
+    signal.cross_sectional = True
+
+    return signal
+
+
+@njit(cache=True)
+def _run_loop(open_kernel, close_kernel, open_values, close_values, rows):
+    """Runs a pair of session signals over all the sessions
+
+    Parameters
+    ----------
+    open_kernel : function
+        Session signal at market open
+
+    close_kernel : function
+        Session signal at market close
+
+    open_values : numpy.ndarray
+        Open prices of the market data
+
+    close_values : numpy.ndarray
+        Close prices of the market data
+
+    rows : numpy.ndarray
+        Positions of the sessions in the market data
+
+    Returns
+    ----------
+    open_actions : numpy.ndarray
+        Actions taken at the open of every session
+    close_actions : numpy.ndarray
+        Actions taken at the close of every session
+    """
+
+    n_sessions = len(rows)
+    open_actions = np.zeros((n_sessions, open_values.shape[1]))
+    close_actions = np.zeros((n_sessions, open_values.shape[1]))
+
+    for i in range(n_sessions):
+        open_actions[i] = open_kernel(i, open_values, close_values, rows, open_actions, close_actions)
+        close_actions[i] = close_kernel(i, open_values, close_values, rows, open_actions, close_actions)
+
+    return open_actions, close_actions
+
+
 # Strategies
+#
+# All the signals take the market data, the rows of the sessions of the backtest in the market data and,
+# for close signals, the actions taken at the open of those sessions, and return an array with the actions
+# of every session (one row per session, one column per symbol)
 
-def buy_at_start(t, quotes, open_actions, close_actions):
+def buy_at_start(quotes, rows, open_actions):
     """Buy a stock of each asset if it's the first day of strategy
         Stay neutral otherwise
 
     Parameters
     ----------
-    t : date
-        Date of the session
-
     quotes : Quotes
         Market data
 
-    open_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session open
+    rows : numpy.ndarray
+        Positions of the sessions in the market data
 
-    close_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session close
+    open_actions : numpy.ndarray
+        Actions taken in the session opens (None for open signals)
 
     Returns
     ----------
-    pandas.DataFrame
-        DataFrame with the actions on the open of t
+    numpy.ndarray
+        Array with the actions of every session
     """
 
-    if t == open_actions.index[0]:
-        actions = np.ones(open_actions.shape[1])
-    else:
-        actions = np.zeros(open_actions.shape[1])
+    actions = np.zeros((len(rows), quotes.close.shape[1]), dtype=np.int8)
+    actions[0, :] = 1
 
     return actions
 
 
-def hold(t, quotes, open_actions, close_actions):
+def hold(quotes, rows, open_actions):
     """Do nothing
 
     Parameters
     ----------
-    t : date
-        Date of the session
-
     quotes : Quotes
         Market data
 
-    open_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session open
+    rows : numpy.ndarray
+        Positions of the sessions in the market data
 
-    close_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session close
+    open_actions : numpy.ndarray
+        Actions taken in the session opens (None for open signals)
 
     Returns
     ----------
-    pandas.DataFrame
-        DataFrame with the actions on the open of t
+    numpy.ndarray
+        Array with the actions of every session
     """
 
-    return np.zeros(open_actions.shape[1])
+    return np.zeros((len(rows), quotes.close.shape[1]), dtype=np.int8)
 
 
-def close_all(t, quotes, open_actions, close_actions):
-    """Close all open positions
+def close_all(quotes, rows, open_actions, close_actions):
+    """Close all open positions at the close of the last session
 
     Parameters
     ----------
-    t : date
-        Date of the session
-
     quotes : Quotes
         Market data
 
-    open_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session open
+    rows : numpy.ndarray
+        Positions of the sessions in the market data
+
+    open_actions : numpy.ndarray
+        Actions taken in the session opens
 
-    close_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session close
+    close_actions : numpy.ndarray
+        Actions taken in the session closes (the last row is ignored)
 
     Returns
     ----------
-    pandas.DataFrame
-        DataFrame with the actions on the open of t
+    numpy.ndarray
+        Array with the actions on the close of the last session
     """
 
-    # Note that this assumes that actions start filled with zeros
-    open_positions = (open_actions.loc[open_actions.index <= t,:] +
-                      close_actions.loc[close_actions.index <= t,:]).sum().as_matrix()
+    # Note that this assumes that there are no positions before the first session
+    open_positions = open_actions.sum(axis=0) + close_actions[:-1].sum(axis=0)
 
     return -open_positions
 
 
-def mimic_open(t, quotes, open_actions, close_actions):
+def mimic_open(quotes, rows, open_actions):
     """Mimic strategy at session open:
     
         Buy 1 stock at market open, if the close price of the previous trading day was
@@ -294,22 +644,19 @@ def mimic_open(t, quotes, open_actions, close_actions):
 
     Parameters
     ----------
-    t : date
-        Date of the session
-    
     quotes : Quotes
         Market data
-        
-    open_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session open
-        
-    close_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session close
+
+    rows : numpy.ndarray
+        Positions of the sessions in the market data
+
+    open_actions : numpy.ndarray
+        Actions taken in the session opens (None for open signals)
 
     Returns
     ----------
-    pandas.DataFrame
-        DataFrame with the actions on the open of t
+    numpy.ndarray
+        Array with the actions of every session
         
     Raises
     ----------
@@ -317,45 +664,40 @@ def mimic_open(t, quotes, open_actions, close_actions):
         If there is not enough data en self.quotes.close
     """
 
-    try:
-        previous_day = max(quotes.close.index[quotes.close.index < t])
-    except:
-        date_error = 'Cannot find the previous day to {} in self.quotes.close'.format(t)
-        raise(ValueError(date_error))
+    if rows[0] < 1:
+        date_error = 'Cannot find the previous day to {} in self.quotes.close'.format(quotes.close.index[rows[0]])
+        raise ValueError(date_error)
 
-    previous_open = quotes.open.loc[previous_day, :]
-    previous_close = quotes.close.loc[previous_day, :]
+    # Row i of the result depends on the row before each session
+    previous_day = rows - 1
 
-    return np.sign(previous_close - previous_open)
+    return np.sign(quotes.close.values[previous_day] - quotes.open.values[previous_day])
 
 
-def close_daily_positions(t, quotes, open_actions, close_actions):
+def close_daily_positions(quotes, rows, open_actions):
     """Close all positions opened at session open
 
     Parameters
     ----------
-    t : date
-        Date of the session
-
     quotes : Quotes
         Market data
 
-    open_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session open
+    rows : numpy.ndarray
+        Positions of the sessions in the market data
 
-    close_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session close
+    open_actions : numpy.ndarray
+        Actions taken in the session opens
 
     Returns
     ----------
-    pandas.DataFrame
-        DataFrame with the actions necessary to close all positions
+    numpy.ndarray
+        Array with the actions necessary to close all positions
     """
 
-    return -open_actions.loc[t, :]
+    return -open_actions
 
 
-def volatility_strategy(t, quotes, open_actions, close_actions):
+def volatility_strategy(quotes, rows, open_actions):
     """Volatility strategy
 
             Buy 1 stock at market open, if daily volatility has reduced during the last trading
@@ -370,22 +712,19 @@ def volatility_strategy(t, quotes, open_actions, close_actions):
 
     Parameters
     ----------
-    t : date
-        Date of the session
-
     quotes : Quotes
         Market data
 
-    open_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session open
+    rows : numpy.ndarray
+        Positions of the sessions in the market data
 
-    close_actions : pandas.DataFrame
-        DataFrame with the actions taken in the session close
+    open_actions : numpy.ndarray
+        Actions taken in the session opens (None for open signals)
 
     Returns
     ----------
-    pandas.DataFrame
-        DataFrame with the actions on the open of t
+    numpy.ndarray
+        Array with the actions of every session
         
     Raises
     ----------
@@ -393,15 +732,16 @@ def volatility_strategy(t, quotes, open_actions, close_actions):
         If there is not enough data en self.quotes.close
     """
 
-    try:
-        previous_day = max(quotes.close.index[quotes.close.index < t])
-        two_days_ago = max(quotes.close.index[quotes.close.index < previous_day])
-    except:
-        date_error = 'Cannot find the two previous days to {} in self.quotes.close'.format(t)
-        raise(ValueError(date_error))
-
-    vol_previous = (quotes.close.loc[previous_day, :] - quotes.open.loc[previous_day, :]) ** 2
-    vol_two_days_ago = (quotes.close.loc[two_days_ago, :] - quotes.open.loc[two_days_ago, :]) ** 2
+    if rows[0] < 2:
+        date_error = 'Cannot find the two previous days to {} in self.quotes.close'.format(quotes.close.index[rows[0]])
+        raise ValueError(date_error)
+
+    # Squared intraday moves, computed once for every day from two days before the first session
+    first = rows[0] - 2
+    vol = (quotes.close.values[first:rows[-1]] - quotes.open.values[first:rows[-1]]) ** 2
+
+    vol_previous = vol[rows - 1 - first]
+    vol_two_days_ago = vol[rows - 2 - first]
 
     return np.sign(vol_two_days_ago - vol_previous)
 